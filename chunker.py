@@ -1,58 +1,123 @@
-import threading
+import os
+import numpy as np
+from numba import njit, types, uint8, uint32, uint64, int64
 
-WINDOW_SIZE = 64
-#POLYNOMIAL = 0xEDB88320
-POLYNOMIAL = 0x3DA3358B4DC173
-TARGET_MASK = 0x3FF #average 1KB
-MAX_CHUNK_SIZE = 1024 * 16 #16 KB
 MIN_CHUNK_SIZE = 512 #0.5 KB
+AVG_CHUNK_SIZE = 1024 #1 KB
+MAX_CHUNK_SIZE = 1024 * 16 #16 KB
+GEAR_SEED = 0x6A09E667F3BCC908
+# CPUs this process may run on, which under cgroups or taskset can be fewer than os.cpu_count()
+SCAN_WORKERS = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+
+# FastCDC normalized chunking (level 2): a harder mask before the average size and an
+# easier one after it. Gear shifts left once per byte, so the top bits carry the last
+# 64 bytes of input; the masks test those instead of the low bits.
+MASK_S = ((1 << 12) - 1) << 52 #log2(AVG) + 2 bits
+MASK_L = ((1 << 8) - 1) << 56 #log2(AVG) - 2 bits
+
+# Typed constants so the kernel never mixes uint64 with int64 (numba would promote to float)
+_MASK_S = np.uint64(MASK_S)
+_MASK_L = np.uint64(MASK_L)
+_SHIFT = np.uint64(1)
+# np.frombuffer over bytes yields a read-only view
+_DATA = types.Array(uint8, 1, 'C', readonly=True)
+
+def _gear_table(seed=GEAR_SEED):
+    # splitmix64, so the table (and every chunk boundary) is stable across runs
+    table = []
+    state = seed
+    for _ in range(256):
+        state = (state + 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+        z = state
+        z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+        z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+        table.append(z ^ (z >> 31))
+    return np.asarray(table, dtype=np.uint64)
+
+# Numba freezes globals into the compiled code, so the kernels see the Gear table
+# and the size limits as constants rather than loading them from arguments
+_GEAR = _gear_table()
+
+@njit(types.Tuple((int64, uint64))(_DATA, int64, int64, int64, uint64, uint64), cache=True, boundscheck=False, nogil=True)
+def _scan_phase(data, start, i, stop, h, mask):
+    # Eight bytes per iteration. The eight mask tests are OR-ed without short-circuiting,
+    # so the loop body has one data-dependent branch that fires about once per chunk.
+    while i + 8 <= stop:
+        p = start + i
+        h0 = (h << _SHIFT) + _GEAR[data[p]]
+        h1 = (h0 << _SHIFT) + _GEAR[data[p + 1]]
+        h2 = (h1 << _SHIFT) + _GEAR[data[p + 2]]
+        h3 = (h2 << _SHIFT) + _GEAR[data[p + 3]]
+        h4 = (h3 << _SHIFT) + _GEAR[data[p + 4]]
+        h5 = (h4 << _SHIFT) + _GEAR[data[p + 5]]
+        h6 = (h5 << _SHIFT) + _GEAR[data[p + 6]]
+        h7 = (h6 << _SHIFT) + _GEAR[data[p + 7]]
+        hit = (((h0 & mask) == 0) | ((h1 & mask) == 0) | ((h2 & mask) == 0) | ((h3 & mask) == 0)
+               | ((h4 & mask) == 0) | ((h5 & mask) == 0) | ((h6 & mask) == 0) | ((h7 & mask) == 0))
+        if hit:
+            # Rare path: find the first lane that cut
+            if (h0 & mask) == 0:
+                return i, h0
+            if (h1 & mask) == 0:
+                return i + 1, h1
+            if (h2 & mask) == 0:
+                return i + 2, h2
+            if (h3 & mask) == 0:
+                return i + 3, h3
+            if (h4 & mask) == 0:
+                return i + 4, h4
+            if (h5 & mask) == 0:
+                return i + 5, h5
+            if (h6 & mask) == 0:
+                return i + 6, h6
+            return i + 7, h7
+        h = h7
+        i += 8
+
+    while i < stop:
+        h = (h << _SHIFT) + _GEAR[data[start + i]]
+        if (h & mask) == 0:
+            return i, h
+        i += 1
+    return -1, h
+
+@njit(uint64(_DATA, int64), cache=True, boundscheck=False, nogil=True)
+def _fastcdc_scan(data, start):
+    n = min(len(data) - start, MAX_CHUNK_SIZE)
+    if n <= MIN_CHUNK_SIZE:
+        return n
+
+    barrier = min(n, AVG_CHUNK_SIZE)
+    cut, h = _scan_phase(data, start, MIN_CHUNK_SIZE, barrier, np.uint64(0), _MASK_S)
+    if cut >= 0:
+        return cut
+    cut, h = _scan_phase(data, start, barrier, n, h, _MASK_L)
+    if cut >= 0:
+        return cut
+
+    return n
+
+@njit(types.Tuple((uint64[::1], uint32[::1]))(_DATA, int64, int64), cache=True, boundscheck=False, nogil=True)
+def _fastcdc_cuts(data, begin, stop):
+    # Every chunk starting before stop, in one call; the last one may run past stop
+    capacity = (len(data) - begin) // MIN_CHUNK_SIZE + 1
+    offsets = np.empty(capacity, dtype=np.uint64)
+    sizes = np.empty(capacity, dtype=np.uint32)
+    n = 0
+    start = begin
+    while start < stop:
+        size = _fastcdc_scan(data, start)
+        offsets[n] = start
+        sizes[n] = size
+        n += 1
+        start += size
+    return offsets[:n], sizes[:n]
 
 class Chunker:
-    def __init__(self):
-        self.local_storage = threading.local()
-        self.table = self._precompute_table()
-
-    def _precompute_table(self):
-        table = [0] * 256
-        for i in range(256):
-            hash_val = i
-            for _ in range(8):
-                if hash_val & 1:
-                    hash_val = (hash_val >> 1) ^ POLYNOMIAL
-                else:
-                    hash_val >>= 1
-            table[i] = hash_val
-        return table
-
-    def _init_thread_local(self):
-        if not hasattr(self.local_storage, "window"):
-            self.local_storage.window = [0] * WINDOW_SIZE
-            self.local_storage.hash = 0
-            self.local_storage.window_pos = 0
-
-    def _update_hash(self, byte):
-        self._init_thread_local()
-        dropped_byte = self.local_storage.window[self.local_storage.window_pos]
-        self.local_storage.window[self.local_storage.window_pos] = byte
-        self.local_storage.window_pos = (self.local_storage.window_pos + 1) % WINDOW_SIZE
-
-        self.local_storage.hash = (
-            (self.local_storage.hash << 8) & 0xFFFFFFFFFFFFFFFF
-        ) ^ self.table[byte] ^ self.table[dropped_byte]
-
-    def determine_chunk_size(self, data: bytes, start: int) -> int:
-        self._init_thread_local()
-        end = min(start + MAX_CHUNK_SIZE, len(data))
-        window_fill = min(WINDOW_SIZE, len(data) - start)
-
-        for i in range(window_fill):
-            self._update_hash(data[start + i])
-
-        i = start + max(window_fill, MIN_CHUNK_SIZE)
-        while i < end:
-            self._update_hash(data[i])
-            if (self.local_storage.hash & TARGET_MASK) == 0:
-                return i - start
-            i += 1
-
-        return end - start
\ No newline at end of file
+    def determine_chunk_size(self, data: np.ndarray, start: int) -> int:
+        # data is a uint8 view (np.frombuffer) built once per buffer by the caller
+        return int(_fastcdc_scan(data, start))
+
+    def chunk_boundaries(self, data: np.ndarray, begin: int, stop: int) -> tuple:
+        """(offsets, sizes) of the chunks of data that start in [begin, stop)."""
+        return _fastcdc_cuts(data, begin, stop)
@@ -1,46 +1,170 @@
 import os
-import hashlib
 import statistics
-from collections import defaultdict
-from chunker import Chunker
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import xxhash
+from numba import njit, int64, uint32, uint64
+from chunker import Chunker, MAX_CHUNK_SIZE, SCAN_WORKERS
+
+INITIAL_BUCKETS = 1 << 16
+MAX_LOAD = 0.7
+READ_SIZE = 4 * 1024 * 1024 #4 MB
+BATCH_BYTES = 64 * 1024 * 1024 #64 MB of small files per worker task
+BATCH_FILES = 1024
+
+@njit(int64(uint64[::1], uint32[::1], uint64[::1], uint32[::1]), cache=True, boundscheck=False)
+def _add_keys(table_keys, table_counts, keys, counts):
+    # Open addressing with linear probing; a zero count marks an empty bucket.
+    # Keys are xxh3 digests, so their low bits are already uniformly spread.
+    mask = np.uint64(len(table_keys) - 1)
+    added = 0
+    for j in range(len(keys)):
+        key = keys[j]
+        slot = key & mask
+        while table_counts[slot] != 0 and table_keys[slot] != key:
+            slot = (slot + np.uint64(1)) & mask
+        if table_counts[slot] == 0:
+            table_keys[slot] = key
+            added += 1
+        table_counts[slot] += counts[j]
+    return added
+
+class HashCounter:
+    """Occurrence counts keyed by the 64-bit xxh3 digest of each chunk."""
+
+    def __init__(self, capacity=INITIAL_BUCKETS):
+        self.keys = np.zeros(capacity, dtype=np.uint64)
+        self.counts = np.zeros(capacity, dtype=np.uint32)
+        self.unique = 0
+
+    def add_keys(self, keys: np.ndarray):
+        if not len(keys):
+            return
+        self.merge(keys, np.ones(len(keys), dtype=np.uint32))
+
+    def merge(self, keys: np.ndarray, counts: np.ndarray):
+        self._reserve(self.unique + len(keys))
+        self.unique += _add_keys(self.keys, self.counts, keys, counts)
+
+    def items(self):
+        live = self.counts != 0
+        return self.keys[live], self.counts[live]
+
+    def _reserve(self, needed):
+        capacity = len(self.keys)
+        while needed > capacity * MAX_LOAD:
+            capacity *= 2
+        if capacity == len(self.keys):
+            return
+
+        live = self.counts != 0
+        old_keys, old_counts = self.keys[live], self.counts[live]
+        self.keys = np.zeros(capacity, dtype=np.uint64)
+        self.counts = np.zeros(capacity, dtype=np.uint32)
+        _add_keys(self.keys, self.counts, old_keys, old_counts)
+
+def _scan_keys(chunker, view, buf, length, final):
+    # Like ingest.scan_range, but keyed by xxh3: the analyzer only counts repeats, so it
+    # does not need the cryptographic digests the filesystem stores chunks under.
+    stop = length if final else length - MAX_CHUNK_SIZE + 1
+    offsets, sizes = chunker.chunk_boundaries(view, 0, stop)
+    keys = np.empty(len(sizes), dtype=np.uint64)
+    with memoryview(buf) as mv:
+        for n, (start, chunk_size) in enumerate(zip(offsets.tolist(), sizes.tolist())):
+            keys[n] = xxhash.xxh3_64_intdigest(mv[start:start + chunk_size])
+    consumed = int(offsets[-1] + sizes[-1]) if len(sizes) else 0
+    return consumed, sizes, keys
+
+def _scan_tree(directory):
+    # os.scandir hands back file sizes without a separate stat per file
+    stack = [directory]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file():
+                        yield entry.path, entry.stat().st_size
+        except OSError as e:
+            print(f"Skipping {e.filename}: {e}")
+
+def _size_bands(files):
+    # Files of BATCH_BYTES or more get a task of their own, smaller ones are packed
+    # together. Largest tasks go first so a huge file does not end up running alone.
+    tasks = []
+    batch, batch_bytes = [], 0
+    for path, size in sorted(files, key=lambda item: item[1], reverse=True):
+        if size >= BATCH_BYTES:
+            tasks.append([path])
+            continue
+        batch.append(path)
+        batch_bytes += size
+        if batch_bytes >= BATCH_BYTES or len(batch) >= BATCH_FILES:
+            tasks.append(batch)
+            batch, batch_bytes = [], 0
+    if batch:
+        tasks.append(batch)
+    return tasks
+
+def _analyze_batch(paths):
+    analyzer = DedupAnalyzer(None)
+    for path in paths:
+        analyzer.try_analyze_file(path)
+    keys, counts = analyzer.chunk_hashes.items()
+    return keys, counts, analyzer.chunk_sizes, analyzer.total_chunks
 
 class DedupAnalyzer:
     def __init__(self, directory):
         self.directory = directory
         self.chunker = Chunker()
-        self.chunk_hashes = defaultdict(int)
+        self.chunk_hashes = HashCounter()
         self.chunk_sizes = []
         self.total_chunks = 0
 
-    def _hash_chunk(self, chunk: bytes) -> str:
-        return hashlib.sha256(chunk).hexdigest()
-
     def analyze_file(self, file_path):
-        with open(file_path, 'rb') as f:
-            data = f.read()
-        start = 0
-        while start < len(data):
-            chunk_size = self.chunker.determine_chunk_size(data, start)
-            chunk = data[start:start + chunk_size]
-            chunk_hash = self._hash_chunk(chunk)
-
-            self.chunk_hashes[chunk_hash] += 1
-            self.chunk_sizes.append(len(chunk))
-            self.total_chunks += 1
-
-            start += chunk_size
-
-    def analyze_directory(self):
-        for root, _, files in os.walk(self.directory):
-            for filename in files:
-                filepath = os.path.join(root, filename)
-                try:
-                    self.analyze_file(filepath)
-                except Exception as e:
-                    print(f"Skipping {filepath}: {e}")
+        # Stream the file through one reusable buffer. Bytes after the last cut that is
+        # final are moved to the front and chunked together with the next read.
+        buf = bytearray(READ_SIZE + MAX_CHUNK_SIZE)
+        view = np.frombuffer(buf, dtype=np.uint8)
+        tail = 0
+        with open(file_path, 'rb') as f, memoryview(buf) as mv:
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            while True:
+                read = f.readinto(mv[tail:tail + READ_SIZE])
+                length = tail + read
+                if not length:
+                    break
+                final = read == 0
+                consumed, sizes, keys = _scan_keys(self.chunker, view[:length], buf, length, final)
+
+                self.chunk_hashes.add_keys(keys)
+                self.chunk_sizes.extend(sizes.tolist())
+                self.total_chunks += len(sizes)
+
+                if final:
+                    break
+                tail = length - consumed
+                buf[:tail] = buf[consumed:length]
+
+    def try_analyze_file(self, file_path):
+        try:
+            self.analyze_file(file_path)
+        except Exception as e:
+            print(f"Skipping {file_path}: {e}")
+
+    def analyze_directory(self, workers=None):
+        # Each worker runs a private analyzer over its batch; results are merged here
+        tasks = _size_bands(_scan_tree(self.directory))
+        with ProcessPoolExecutor(max_workers=workers or SCAN_WORKERS) as executor:
+            for keys, counts, sizes, total in executor.map(_analyze_batch, tasks):
+                self.chunk_hashes.merge(keys, counts)
+                self.chunk_sizes.extend(sizes)
+                self.total_chunks += total
 
     def report(self):
-        total_unique = len(self.chunk_hashes)
+        total_unique = self.chunk_hashes.unique
         redundant_chunks = self.total_chunks - total_unique
         redundancy_ratio = redundant_chunks / self.total_chunks if self.total_chunks > 0 else 0
 
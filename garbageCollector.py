@@ -1,9 +1,24 @@
 import threading
 import os
-import io
-import shutil
 from storage import ChunkStorage
-import json
+from ingest import digest_list
+
+def _copy_range(src_fd, dst_fd, size, src_offset, dst_offset):
+    while size > 0:
+        copied = os.copy_file_range(src_fd, dst_fd, size, src_offset, dst_offset)
+        if copied == 0:
+            raise IOError("container truncated while compacting")
+        size -= copied
+        src_offset += copied
+        dst_offset += copied
+
+def _copy_chunks(src_fd, dst_fd, chunks, container_file, new_offset, new_metadata):
+    # Copy chunks in their original order from new_offset on, recording where each lands
+    for chunk_hash, (_, offset, size) in sorted(chunks.items(), key=lambda item: item[1][1]):
+        _copy_range(src_fd, dst_fd, size, offset, new_offset)
+        new_metadata[chunk_hash] = (container_file, new_offset, size)
+        new_offset += size
+    return new_offset
 
 class GarbageCollector(threading.Thread):
     def __init__(self, storage: ChunkStorage, chunk_dir: str, interval: int = 0):
@@ -33,67 +48,70 @@ class GarbageCollector(threading.Thread):
         with self.lock:
             #print("[GC] Starting garbage collection")
 
-            # MARK: collect used chunks
-            file_chunks = self.storage.get_all_file_chunks()
-            used_chunks = set()
-            for chunks in file_chunks.values():
-                for chunk_hash, _ in chunks:
-                    used_chunks.add(chunk_hash)
-
-            # Map container files to chunks that need to be preserved
-            container_map = {}  # container_file: list of (chunk_hash, offset, size)
-            for chunk_hash in used_chunks:
-                meta = self.storage.get_chunk_metadata(chunk_hash)
-                if not meta:
-                    continue  # skip broken entries
-                container, offset, size = meta
-                container_map.setdefault(container, []).append((chunk_hash, offset, size))
-
-            # SWEEP: rewrite containers with only live chunks
-            temp_metadata_file = os.path.join(self.chunk_dir, "temp_metadata.json")
-            with open(temp_metadata_file, 'w') as temp_out:
-                pass
-            for container_file, chunks in container_map.items():
+            # MARK: collect used chunks. Stores are held off until the dead entries are gone,
+            # so none can dedup against a chunk about to be deleted or have its new chunks
+            # taken for garbage before its chunk list is recorded.
+            with self.storage.store_gate:
+                known_chunks = self.storage.get_all_chunk_hashes()
+                file_chunks = self.storage.get_all_file_chunks()
+                used_chunks = set()
+                for hashes, _ in file_chunks.values():
+                    used_chunks.update(digest_list(hashes))
+
+                # Drop every unreferenced index entry in one batch
+                self.storage.delete_chunk_metadata(known_chunks - used_chunks)
+
+            # SWEEP: rewrite containers holding dead chunks with only their live ones, copying
+            # ranges in-kernel. The snapshot is taken with stores held off, so each container's
+            # entries account for its whole size.
+            with self.storage.store_gate:
+                live_chunks = self.storage.get_chunks_by_container()
+                container_sizes = {
+                    container_file: self.storage.get_container_size(container_file)
+                    for container_file in os.listdir(self.chunk_dir) if container_file.endswith(".container")
+                }
+
+            for container_file, size in sorted(container_sizes.items()):
                 container_path = os.path.join(self.chunk_dir, container_file)
-
-                if not os.path.exists(container_path):
+                live = live_chunks.get(container_file, {})
+
+                if not live:
+                    with self.storage.store_gate, self.storage.container_lock(container_file):
+                        # Left alone if chunks were stored in it since the snapshot
+                        if self.storage.get_container_size(container_file) == size:
+                            #print(f"[GC] Removing unused container: {container_file}")
+                            os.remove(container_path)
+                            self.storage.invalidate_container(container_file)
                     continue
 
-                # Sort chunks by original offset
-                chunks.sort(key=lambda x: x[1])
-
-                with open(container_path, 'rb') as f:
-                    new_container = io.BytesIO()
-                    new_metadata = {}
-
-                    for chunk_hash, offset, size in chunks:
-                        f.seek(offset)
-                        chunk_data = f.read(size)
-
-                        new_offset = new_container.tell()
-                        new_container.write(chunk_data)
-                        new_metadata[chunk_hash] = (container_file, new_offset, size)
+                if sum(meta[2] for meta in live.values()) == size:
+                    continue  # Nothing dead in it
 
-                # Write new container file (atomic replace)
+                # Write new container file (atomic replace). Stores only append, so the live
+                # chunks are copied without holding them off; those appended meanwhile are
+                # carried over once they are.
                 temp_path = container_path + ".tmp"
-                with open(temp_path, 'wb') as out:
-                    out.write(new_container.getvalue())
-                shutil.move(temp_path, container_path)
-
-                # Build updated metadata table
-                with open(temp_metadata_file, 'w') as out:
-                    out.write(json.dumps(new_metadata))
-                
-            # Replace old metadata with new metadata
-            shutil.move(temp_metadata_file, os.path.join(self.chunk_dir, "chunk_metadata.json"))
-
-            # Now find all containers, and remove any not used
-            all_containers = set(os.listdir(self.chunk_dir))
-            live_containers = set(container_map.keys())
-            for filename in all_containers:
-                if filename not in live_containers and filename.endswith(".container"):
-                    path = os.path.join(self.chunk_dir, filename)
-                    #print(f"[GC] Removing unused container: {filename}")
-                    os.remove(path)
+                new_metadata = {}
+                src_fd = os.open(container_path, os.O_RDONLY)
+                try:
+                    dst_fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+                    try:
+                        new_offset = _copy_chunks(src_fd, dst_fd, live, container_file, 0, new_metadata)
+                        with self.storage.store_gate, self.storage.container_lock(container_file):
+                            if self.storage.get_container_size(container_file) != size:
+                                added = {
+                                    chunk_hash: meta
+                                    for chunk_hash, meta in self.storage.get_container_chunks(container_file).items()
+                                    if chunk_hash not in live
+                                }
+                                _copy_chunks(src_fd, dst_fd, added, container_file, new_offset, new_metadata)
+
+                            # Swap the file and publish its new locations in one step; a read
+                            # that overlaps it sees relocated_since() and reads again
+                            self.storage.replace_container(container_file, temp_path, new_metadata)
+                    finally:
+                        os.close(dst_fd)
+                finally:
+                    os.close(src_fd)
 
             #print("[GC] Completed garbage collection")
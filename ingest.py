@@ -0,0 +1,87 @@
+import blake3
+import numpy as np
+from multiprocessing import shared_memory
+from chunker import Chunker, MAX_CHUNK_SIZE
+
+DIGEST_SIZE = 32
+
+# Chunker owned by each worker process, built once by the pool initializer
+_worker_chunker = None
+
+def init_worker():
+    global _worker_chunker
+    _worker_chunker = Chunker()
+
+def scan_range(chunker: Chunker, view: np.ndarray, buf, begin: int, end: int) -> tuple:
+    """Chunk and hash buf[begin:end].
+
+    Returns (offsets, sizes, hashes) as parallel arrays: uint64, uint32 and a
+    uint8 (n, DIGEST_SIZE) array of raw digests.
+    """
+    offsets, sizes = chunker.chunk_boundaries(view[:end], begin, end)
+    hashes = np.frombuffer(hash_many(buf, offsets, sizes), dtype=np.uint8).reshape(-1, DIGEST_SIZE)
+    return offsets, sizes, hashes
+
+def hash_many(buf, offsets: np.ndarray, sizes: np.ndarray) -> bytearray:
+    """BLAKE3 digests of the chunks of buf at (offsets, sizes), concatenated."""
+    # Each chunk is hashed through a view rather than a copy. One hasher is reset
+    # between chunks instead of building a new one per chunk, and its methods are
+    # looked up once for the whole batch.
+    digests = bytearray()
+    hasher = blake3.blake3()
+    update, digest, reset, append = hasher.update, hasher.digest, hasher.reset, digests.extend
+    with memoryview(buf) as mv:
+        for start, end in zip(offsets.tolist(), (offsets + sizes).tolist()):
+            update(mv[start:end])
+            append(digest())
+            reset()
+    return digests
+
+def empty_chunks() -> tuple:
+    """(hashes, sizes) of a file with no chunks, in the layout scan_range returns."""
+    return np.empty((0, DIGEST_SIZE), dtype=np.uint8), np.empty(0, dtype=np.uint32)
+
+def digest_list(hashes: np.ndarray) -> list:
+    blob = hashes.tobytes()
+    return [blob[i:i + DIGEST_SIZE] for i in range(0, len(blob), DIGEST_SIZE)]
+
+def scan_shared(name: str, begin: int, end: int) -> tuple:
+    shm = shared_memory.SharedMemory(name=name)
+    view = np.frombuffer(shm.buf, dtype=np.uint8)
+    try:
+        return scan_range(_worker_chunker, view, shm.buf, begin, end)
+    finally:
+        del view
+        shm.close()
+
+def split_points(chunker: Chunker, view: np.ndarray, parts: int) -> list:
+    # Each seam is moved to the first content-defined cut after its nominal position,
+    # so slices start where the sequential chunker could have started too
+    n = len(view)
+    step = max(2 * MAX_CHUNK_SIZE, -(-n // parts))
+    points = [0]
+    nominal = step
+    while nominal < n:
+        cut = nominal + chunker.determine_chunk_size(view, nominal)
+        if cut >= n:
+            break
+        points.append(cut)
+        nominal = cut + step
+    points.append(n)
+    return points
+
+def parallel_scan(executor, chunker: Chunker, data: bytes, view: np.ndarray, parts: int) -> tuple:
+    """Run scan_range over slices of data in worker processes, sharing one copy of data."""
+    shm = shared_memory.SharedMemory(create=True, size=len(data))
+    try:
+        shm.buf[:len(data)] = data
+        points = split_points(chunker, view, parts)
+        futures = [
+            executor.submit(scan_shared, shm.name, begin, end)
+            for begin, end in zip(points, points[1:])
+        ]
+        results = [future.result() for future in futures]
+        return tuple(np.concatenate(column) for column in zip(*results))
+    finally:
+        shm.close()
+        shm.unlink()
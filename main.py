@@ -1,15 +1,21 @@
 import os
-import hashlib
 from fusepy import FUSE, FuseOSError, Operations, fuse_get_context, errno
 from collections import defaultdict
-from chunker import Chunker
-from storage import ChunkStorage
-import io
+from chunker import Chunker, SCAN_WORKERS
+from storage import ChunkStorage, container_name_for
 import time
 import threading
-from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from garbageCollector import GarbageCollector
-import mmap
+from ingest import digest_list, empty_chunks, init_worker, parallel_scan, scan_range
+import numpy as np
+
+PARALLEL_MIN_BYTES = 1024 * 1024 #1 MB, below this worker dispatch costs more than it saves
+COALESCE_GAP = 1024 * 64 #64 KB, read through smaller holes instead of issuing another preadv
+MAX_IOV = 1024 #IOV_MAX on Linux
+LOCK_STRIPES = 64 #power of two
+WRITE_BUFFER_BYTES = 1024 * 1024 #1 MB of sequential writes gathered per handle before chunking
 
 class FilesystemDedup(Operations):
     def __init__(self, root):
@@ -17,21 +23,37 @@ class FilesystemDedup(Operations):
         self.chunk_dir = os.path.join(root, ".dedup_store")
         self.chunker = Chunker()
         self.storage = ChunkStorage(self.chunk_dir)
-        self.file_chunks = defaultdict(list, self.storage.get_all_file_chunks())
-        self.executor = ThreadPoolExecutor(max_workers=8)
+        self.file_chunks = defaultdict(empty_chunks, self.storage.get_all_file_chunks())
+        self.chunk_ends = {}  # path: (sizes array, cumulative chunk ends)
+        self.write_buffers = {}  # fh: [path, base offset, pending bytes]
+        # forkserver: forking the multi-threaded FUSE process is not safe
+        self.executor = ProcessPoolExecutor(
+            max_workers=SCAN_WORKERS,
+            mp_context=multiprocessing.get_context("forkserver"),
+            initializer=init_worker,
+        )
         self.garbage_collector = GarbageCollector(self.storage, self.chunk_dir, interval=30)
         self.garbage_collector.start()
         #self.garbage_collector.trigger() 
 
         # Locks
-        self.file_locks = defaultdict(threading.RLock)
+        # A fixed set of locks shared out by path hash; paths on the same stripe serialize
+        self.lock_stripes = [threading.RLock() for _ in range(LOCK_STRIPES)]
+
+    def _chunk_ends(self, path, sizes):
+        # Prefix sums of a file's chunk sizes, recomputed only once its chunk list is replaced
+        cached = self.chunk_ends.get(path)
+        if cached is None or cached[0] is not sizes:
+            cached = (sizes, np.cumsum(sizes, dtype=np.uint64))
+            self.chunk_ends[path] = cached
+        return cached[1]
+
+    def _lock_for(self, path):
+        return self.lock_stripes[hash(path) & (LOCK_STRIPES - 1)]
 
     def _full_path(self, partial_path):
         return os.path.join(self.root, partial_path.lstrip('/'))
 
-    def _hash_chunk(self, chunk: bytes) -> str:
-        return hashlib.sha256(chunk).hexdigest()
-
     def getattr(self, path, fh=None):
         full_path = self._full_path(path)
 
@@ -40,7 +62,7 @@ class FilesystemDedup(Operations):
             return {
                 'st_mode': 0o100644,
                 'st_nlink': 1,
-                'st_size': sum(size for _, size in self.file_chunks[path]),
+                'st_size': max(int(self.file_chunks[path][1].sum()), self._pending_end(path)),
                 'st_ctime': now,
                 'st_mtime': now,
                 'st_atime': now,
@@ -78,31 +100,45 @@ class FilesystemDedup(Operations):
         )}
 
     def unlink(self, path):
-        with self.file_locks[path]:
+        with self._lock_for(path):
+            # Writes still buffered for the file are dropped with it
+            for fh, pending in list(self.write_buffers.items()):
+                if pending[0] == path:
+                    del self.write_buffers[fh]
             if path in self.file_chunks:
                 del self.file_chunks[path]
-                self.storage.store_file_chunks(path, [])
+                self.chunk_ends.pop(path, None)
+                self.storage.store_file_chunks(path, None)
             full_path = self._full_path(path)
             if os.path.exists(full_path):
                 os.unlink(full_path)
         return 0
 
     def flush(self, path, fh):
+        with self._lock_for(path):
+            self._drain(fh)
         return 0
 
     def fsync(self, path, datasync, fh):
+        with self._lock_for(path):
+            self._drain(fh)
         return 0
 
     def create(self, path, mode):
-        with self.file_locks[path]:
+        with self._lock_for(path):
             full_path = self._full_path(path)
             fd = os.open(full_path, os.O_WRONLY | os.O_CREAT, mode)
-            self.file_chunks[path] = []
-            self.storage.store_file_chunks(path, [])
+            self.file_chunks[path] = empty_chunks()
+            self.storage.store_file_chunks(path, self.file_chunks[path])
             return fd
 
     def release(self, path, fh):
-        os.close(fh)
+        # The handle is closed even if its last writes cannot be stored
+        try:
+            with self._lock_for(path):
+                self._drain(fh)
+        finally:
+            os.close(fh)
         return 0
 
     def open(self, path, flags):
@@ -113,113 +149,168 @@ class FilesystemDedup(Operations):
         return os.open(full_path, flags)
 
     def write(self, path, data, offset, fh):
-        with self.file_locks[path]:
-            existing_chunks = self.file_chunks[path]
-            new_chunks = []
-
-            # Determine where to insert
-            chunk_start = 0
-            chunk_index = 0
-            while chunk_index < len(existing_chunks) and chunk_start + existing_chunks[chunk_index][1] <= offset:
-                chunk_start += existing_chunks[chunk_index][1]
-                chunk_index += 1
-
-            # Chunk the data and compute hashes in parallel
-            chunk_metadata = {}
-            container_buffer = io.BytesIO()
-            futures = []
-
-            start = 0
-            while start < len(data):
-                chunk_size = self.chunker.determine_chunk_size(data, start)
-                chunk = data[start:start + chunk_size]
-                futures.append((chunk, self.executor.submit(self._hash_chunk, chunk)))
-                start += chunk_size
-
-            current_offset = self.storage.get_container_size(
-                path.strip("/").replace("/", "_") + ".container"
-            )
-            container_offset = current_offset
-
-            for chunk, future in futures:
-                chunk_hash = future.result()
-                if not self.storage.chunk_exists(chunk_hash) and chunk_hash not in chunk_metadata:
-                    container_buffer.write(chunk)
-                    chunk_metadata[chunk_hash] = (path, current_offset, len(chunk))
-                    current_offset += len(chunk)
-                new_chunks.append((chunk_hash, len(chunk)))
-
-            # Write chunk data and metadata
-            if chunk_metadata:
-                container_buffer.seek(0)
-                self.storage.write_container(path, container_buffer.read(), container_offset)
-                self.storage.write_chunk_metadata(chunk_metadata)
-
-            # Update chunk list
-            self.file_chunks[path] = (
-                existing_chunks[:chunk_index] + new_chunks + existing_chunks[chunk_index + 1:]
-            )
-            self.storage.store_file_chunks(path, self.file_chunks[path])
+        # Sequential writes on a handle are gathered and chunked together once
+        # WRITE_BUFFER_BYTES have built up, or when the handle is flushed or released
+        with self._lock_for(path):
+            pending = self.write_buffers.get(fh)
+            if pending is not None and pending[1] + len(pending[2]) != offset:
+                self._drain(fh)
+                pending = None
+            if pending is None:
+                pending = [path, offset, bytearray()]
+                self.write_buffers[fh] = pending
+            pending[2] += data
+            if len(pending[2]) >= WRITE_BUFFER_BYTES:
+                self._drain(fh)
             return len(data)
 
+    def _drain(self, fh):
+        pending = self.write_buffers.pop(fh, None)
+        if pending is not None:
+            path, offset, data = pending
+            self._store(path, data, offset)
+
+    def _drain_path(self, path):
+        for fh, pending in list(self.write_buffers.items()):
+            if pending[0] == path:
+                self._drain(fh)
+
+    def _pending_end(self, path):
+        end = 0
+        for pending in list(self.write_buffers.values()):
+            if pending[0] == path:
+                end = max(end, pending[1] + len(pending[2]))
+        return end
+
+    def _store(self, path, data, offset):
+        with self._lock_for(path):
+            existing_hashes, existing_sizes = self.file_chunks[path]
+
+            # Determine where to insert: the chunk holding offset, or the end of the file
+            chunk_index = int(np.searchsorted(self._chunk_ends(path, existing_sizes), offset, side='right'))
+
+            # Chunk and hash. BLAKE3 holds the GIL for chunk-sized inputs, so large buffers
+            # get their parallelism from the worker processes instead of threads
+            view = np.frombuffer(data, dtype=np.uint8)
+            if SCAN_WORKERS > 1 and len(data) >= PARALLEL_MIN_BYTES:
+                offsets, sizes, hashes = parallel_scan(self.executor, self.chunker, data, view, SCAN_WORKERS)
+            else:
+                offsets, sizes, hashes = scan_range(self.chunker, view, data, 0, len(data))
+            digests = digest_list(hashes)
+
+            with self.storage.store_gate:
+                # Pick the chunks to store; only the first copy of a chunk repeated within
+                # this write is kept
+                missing = self.storage.missing_chunks(digests)
+                stored_hashes, stored_starts, stored_sizes = [], [], []
+                for start, chunk_size, chunk_hash in zip(offsets.tolist(), sizes.tolist(), digests):
+                    if chunk_hash in missing:
+                        missing.discard(chunk_hash)
+                        stored_hashes.append(chunk_hash)
+                        stored_starts.append(start)
+                        stored_sizes.append(chunk_size)
+
+                # Write chunk data and metadata
+                if stored_hashes:
+                    # Copied once into a buffer of the final size, which goes to the container as is
+                    # Index entries are built in their final form as the bytes are placed
+                    container_buffer = bytearray(sum(stored_sizes))
+                    container_name = container_name_for(path)
+                    container_offset = self.storage.get_container_size(container_name)
+                    chunk_metadata = {}
+                    pos = 0
+                    data_view = memoryview(data)
+                    for chunk_hash, start, chunk_size in zip(stored_hashes, stored_starts, stored_sizes):
+                        container_buffer[pos:pos + chunk_size] = data_view[start:start + chunk_size]
+                        chunk_metadata[chunk_hash] = (container_name, container_offset + pos, chunk_size)
+                        pos += chunk_size
+
+                    self.storage.write_container(path, container_buffer, container_offset)
+                    self.storage.write_chunk_metadata(chunk_metadata)
+
+                # Update chunk list
+                self.file_chunks[path] = (
+                    np.concatenate((existing_hashes[:chunk_index], hashes, existing_hashes[chunk_index + 1:])),
+                    np.concatenate((existing_sizes[:chunk_index], sizes, existing_sizes[chunk_index + 1:])),
+                )
+                self.storage.store_file_chunks(path, self.file_chunks[path], chunk_index)
+
     def read(self, path, size, offset, fh):
-        with self.file_locks[path]:
+        with self._lock_for(path):
+            # Reads must see every write made so far through any handle
+            self._drain_path(path)
             if path not in self.file_chunks:
                 raise FuseOSError(errno.ENOENT)
 
-            chunks = self.file_chunks[path]
-            data = bytearray()
-            current_offset = 0
-            remaining_size = size
-            i = 0
-
-            while i < len(chunks) and len(data) < size:
-                chunk_hash, chunk_size = chunks[i]
-
-                if current_offset + chunk_size <= offset:
-                    current_offset += chunk_size
-                    i += 1
-                    continue
-
-                # Start grouping chunks with the same container
-                current_chunk_meta = self.storage.get_chunk_metadata(chunk_hash)
-                if not current_chunk_meta:
-                    raise FuseOSError(errno.EIO)
-
-                container_file, base_offset, _ = current_chunk_meta
-                # Group by container
-                group_container = container_file
-                first_offset = base_offset
-                last_offset = 0
-                while i < len(chunks):
-                    chunk_hash, chunk_size = chunks[i]
-                    meta = self.storage.get_chunk_metadata(chunk_hash)
-                    if not meta:
-                        raise FuseOSError(errno.EIO)
-                    container, chunk_offset, chunk_len = meta
-
-                    if container != group_container:
-                        last_offset = chunk_offset + chunk_len
-                        break
-                    i += 1
-                    if i >= len(chunks):
-                        last_offset = chunk_offset + chunk_len
-
-                # Read all grouped chunks from the container in a single read
-                container_path = os.path.join(self.chunk_dir, group_container)
-                with open(container_path, 'rb') as f:
-                    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
-                    bulk_data = mm[first_offset:last_offset]
-                    mm.close()
-
-                data.extend(bulk_data[0:min(len(bulk_data), remaining_size)])
-                remaining_size -= len(bulk_data)
-
-            return bytes(data)
+            # Chunks overlapping the requested range, as (chunk_hash, chunk_start, chunk_size)
+            end = offset + size
+            # Two binary searches; only the chunks returned are touched in Python
+            hashes, sizes = self.file_chunks[path]
+            chunk_ends = self._chunk_ends(path, sizes)
+            first = np.searchsorted(chunk_ends, offset, side='right')
+            last = min(np.searchsorted(chunk_ends, end, side='left') + 1, len(sizes))
+            chunk_starts = chunk_ends[first:last] - sizes[first:last]
+            needed = list(zip(
+                digest_list(hashes[first:last]), chunk_starts.tolist(), sizes[first:last].tolist()
+            ))
+            while True:
+                relocations = self.storage.relocations
+                out = self._read_chunks(needed, offset, end)
+                # A compaction between the index lookup and the preadv moves chunks under
+                # the offsets just used; read again once it is done
+                if not self.storage.relocated_since(relocations):
+                    return bytes(out)
+
+    def _read_chunks(self, needed, offset, end):
+        metadata = self.storage.get_chunk_metadata_many(chunk_hash for chunk_hash, _, _ in needed)
+
+        # Map them to (container, container_offset, length, out_pos) pieces
+        pieces = []
+        out_pos = 0
+        for chunk_hash, chunk_start, chunk_size in needed:
+            meta = metadata.get(chunk_hash)
+            if not meta:
+                raise FuseOSError(errno.EIO)
+            container, chunk_offset, _ = meta
+            skip = max(0, offset - chunk_start)
+            length = min(chunk_start + chunk_size, end) - chunk_start - skip
+            pieces.append((container, chunk_offset + skip, length, out_pos))
+            out_pos += length
+
+        # Coalesce pieces that sit close together in the same container into one
+        # preadv each, scattering straight into their slots of the output buffer
+        out = bytearray(out_pos)
+        out_view = memoryview(out)
+        # Bytes in the holes are never used, so every hole reads into the same scratch buffer
+        hole = memoryview(bytearray(COALESCE_GAP))
+        pieces.sort()
+        i = 0
+        while i < len(pieces):
+            container, base_offset, length, pos = pieces[i]
+            buffers = [out_view[pos:pos + length]]
+            run_end = base_offset + length
+            i += 1
+            while i < len(pieces) and len(buffers) < MAX_IOV - 1:
+                next_container, next_offset, next_length, next_pos = pieces[i]
+                gap = next_offset - run_end
+                if next_container != container or gap < 0 or gap >= COALESCE_GAP:
+                    break
+                if gap:
+                    buffers.append(hole[:gap])
+                buffers.append(out_view[next_pos:next_pos + next_length])
+                run_end = next_offset + next_length
+                i += 1
+            self.storage.read_container(container, buffers, base_offset)
+
+        return out
     
     def __del__(self):
+        for fh in list(self.write_buffers):
+            self._drain(fh)
         self.executor.shutdown(wait=True)
         self.garbage_collector.stop()
+        self.storage.read_fds.close()
+        self.storage.write_fds.close()
 
 
 if __name__ == "__main__":
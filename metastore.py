@@ -0,0 +1,224 @@
+import os
+import mmap
+import struct
+import numpy as np
+from numba import njit, types, int64, uint64
+
+RECORD_FORMAT = '<32sQII' #hash | offset | container_id | size
+# Compiled once; the format string is not re-parsed on every pack and unpack
+_RECORD = struct.Struct(RECORD_FORMAT)
+RECORD_SIZE = _RECORD.size #48 bytes, read by the kernels as six uint64 words
+WORDS = RECORD_SIZE // 8
+INITIAL_SLOTS = 1 << 16
+MAX_LOAD = 0.5
+
+_ONE = np.uint64(1)
+_HIGH = np.uint64(32)
+_LOW = np.uint64(0xFFFFFFFF)
+# Keys and records are often np.frombuffer views over bytes, which are read-only
+_ROWS = types.Array(uint64, 2, 'C', readonly=True)
+
+@njit(int64[::1](uint64[:, ::1], _ROWS), cache=True, boundscheck=False, nogil=True)
+def _find_slots(table, keys):
+    # Linear probing from the first hash word; a zero size marks an empty slot.
+    # Keys are digests, so their low bits are already uniformly spread.
+    mask = np.uint64(len(table) - 1)
+    slots = np.empty(len(keys), dtype=np.int64)
+    for j in range(len(keys)):
+        slot = keys[j, 0] & mask
+        while True:
+            if (table[slot, 5] >> _HIGH) == 0:
+                slots[j] = -1
+                break
+            if (table[slot, 0] == keys[j, 0] and table[slot, 1] == keys[j, 1]
+                    and table[slot, 2] == keys[j, 2] and table[slot, 3] == keys[j, 3]):
+                slots[j] = slot
+                break
+            slot = (slot + _ONE) & mask
+    return slots
+
+@njit(int64(uint64[:, ::1], _ROWS), cache=True, boundscheck=False, nogil=True)
+def _insert_records(table, records):
+    # A record for a hash already present overwrites it; returns how many were new
+    mask = np.uint64(len(table) - 1)
+    added = 0
+    for j in range(len(records)):
+        slot = records[j, 0] & mask
+        while (table[slot, 5] >> _HIGH) != 0 and not (
+                table[slot, 0] == records[j, 0] and table[slot, 1] == records[j, 1]
+                and table[slot, 2] == records[j, 2] and table[slot, 3] == records[j, 3]):
+            slot = (slot + _ONE) & mask
+        if (table[slot, 5] >> _HIGH) == 0:
+            added += 1
+        for w in range(WORDS):
+            table[slot, w] = records[j, w]
+    return added
+
+def _key_array(chunk_hashes):
+    return np.frombuffer(b"".join(chunk_hashes), dtype=np.uint64).reshape(-1, 4)
+
+class MetaStore:
+    """Chunk index kept as an open-addressing hash table in an mmap'd file.
+
+    Slots are fixed-size records probed by the leading bytes of their hash, so no
+    per-key Python objects are held in memory. Updates go into the mapping in place;
+    once the table passes MAX_LOAD it is rebuilt at twice the size and swapped in
+    atomically, as rewrite() and delete() do. Container names live in a side file
+    and are referenced by line number, which never changes once assigned.
+    Not thread-safe on its own; ChunkStorage serializes access.
+    """
+
+    def __init__(self, index_path, containers_path):
+        self.index_path = index_path
+        self.containers_path = containers_path
+
+        self.container_names = []
+        self.container_ids = {}
+        self.count = 0
+        self.fd = None
+        self.buf = None
+        self.table = None
+
+        self._load_containers()
+        self._open()
+
+    def get(self, chunk_hash):
+        return self.get_many([chunk_hash])[0]
+
+    def get_many(self, chunk_hashes):
+        # (container_name, offset, size) per hash, None where the hash is unknown
+        if not chunk_hashes:
+            return []
+        slots = _find_slots(self.table, _key_array(chunk_hashes))
+        rows = self.table[np.maximum(slots, 0), 4:].tolist()
+        return [
+            (self.container_names[word & 0xFFFFFFFF], offset, word >> 32) if slot >= 0 else None
+            for slot, (offset, word) in zip(slots.tolist(), rows)
+        ]
+
+    def missing(self, chunk_hashes):
+        if not chunk_hashes:
+            return set()
+        slots = _find_slots(self.table, _key_array(chunk_hashes))
+        return {chunk_hash for chunk_hash, slot in zip(chunk_hashes, slots.tolist()) if slot < 0}
+
+    def __contains__(self, chunk_hash):
+        return not self.missing([chunk_hash])
+
+    def __len__(self):
+        return self.count
+
+    def keys(self):
+        live = self._live_records()[:, :4].tobytes()
+        return [live[i:i + 32] for i in range(0, len(live), 32)]
+
+    def container_entries(self, container):
+        # chunk_hash: (container_name, offset, size) for every live entry in one container
+        container_id = self.container_ids.get(container)
+        if container_id is None:
+            return {}
+        words = self.table[:, 5]
+        rows = self.table[((words >> _HIGH) != 0) & ((words & _LOW) == np.uint64(container_id))]
+        return self._group(rows).get(container, {})
+
+    def entries_by_container(self):
+        # container_entries() for every container, from a single pass over the table
+        return self._group(self._live_records())
+
+    def update(self, entries: dict):
+        # entries: chunk_hash: (container_name, offset, size)
+        if not entries:
+            return
+        records = self._records(entries)
+        if self.count + len(records) > len(self.table) * MAX_LOAD:
+            self._rebuild(np.concatenate((self._live_records(), records)))
+        else:
+            self.count += _insert_records(self.table, records)
+
+    def delete(self, chunk_hashes):
+        """Atomically rebuild the index without these hashes."""
+        if not chunk_hashes:
+            return
+        slots = _find_slots(self.table, _key_array(chunk_hashes))
+        keep = (self.table[:, 5] >> _HIGH) != 0
+        keep[slots[slots >= 0]] = False
+        self._rebuild(self.table[keep])
+
+    def rewrite(self, entries: dict):
+        """Atomically replace the index with exactly these entries."""
+        self._rebuild(self._records(entries))
+
+    def close(self):
+        self.table = None
+        if self.buf is not None:
+            self.buf.close()
+            self.buf = None
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    #Internal Operations
+
+    def _records(self, entries):
+        records = bytearray(len(entries) * RECORD_SIZE)
+        pack_into = _RECORD.pack_into
+        for i, (chunk_hash, (container, offset, size)) in enumerate(entries.items()):
+            pack_into(records, i * RECORD_SIZE, chunk_hash, offset, self._container_id(container), size)
+        return np.frombuffer(records, dtype=np.uint64).reshape(-1, WORDS)
+
+    def _group(self, rows):
+        keys = rows[:, :4].tobytes()
+        grouped = {}
+        for i, (offset, word) in enumerate(rows[:, 4:].tolist()):
+            container = self.container_names[word & 0xFFFFFFFF]
+            grouped.setdefault(container, {})[keys[i * 32:i * 32 + 32]] = (container, offset, word >> 32)
+        return grouped
+
+    def _live_records(self):
+        # A copy, so it stays valid across a remap
+        return self.table[(self.table[:, 5] >> _HIGH) != 0]
+
+    def _rebuild(self, records):
+        slots = INITIAL_SLOTS
+        while len(records) > slots * MAX_LOAD:
+            slots *= 2
+        table = np.zeros((slots, WORDS), dtype=np.uint64)
+        _insert_records(table, np.ascontiguousarray(records))
+
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(table.data)
+            f.flush()
+            os.fsync(f.fileno())
+        self.close()
+        os.replace(tmp_path, self.index_path)
+        self._open()
+
+    def _open(self):
+        self.fd = os.open(self.index_path, os.O_RDWR | os.O_CREAT, 0o644)
+        size = os.fstat(self.fd).st_size
+        if size == 0:
+            size = INITIAL_SLOTS * RECORD_SIZE
+            os.ftruncate(self.fd, size)
+        self.buf = mmap.mmap(self.fd, size)
+        self.table = np.frombuffer(self.buf, dtype=np.uint64).reshape(-1, WORDS)
+        self.count = int(np.count_nonzero(self.table[:, 5] >> _HIGH))
+
+    def _load_containers(self):
+        if os.path.exists(self.containers_path):
+            with open(self.containers_path, 'r') as f:
+                self.container_names = f.read().splitlines()
+        self.container_ids = {name: i for i, name in enumerate(self.container_names)}
+
+    def _container_id(self, name):
+        container_id = self.container_ids.get(name)
+        if container_id is None:
+            # Persist the name before any record can refer to its id
+            with open(self.containers_path, 'a') as f:
+                f.write(name + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            container_id = len(self.container_names)
+            self.container_names.append(name)
+            self.container_ids[name] = container_id
+        return container_id
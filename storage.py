@@ -2,24 +2,119 @@ import os
 import json
 import threading
 import queue
-import shutil
+import sqlite3
+import functools
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+import numpy as np
+from ingest import DIGEST_SIZE, digest_list
+from metastore import MetaStore
+
+FD_CACHE_SIZE = 64
+RETRY_DELAY = 0.1 #seconds before a failed dump is retried, doubled per consecutive failure
+RETRY_DELAY_MAX = 30
+
+@functools.lru_cache(maxsize=4096)
+def container_name_for(path):
+    # Every file's chunks are appended to one container named after its path
+    return path.strip("/").replace("/", "_") + ".container"
+
+class ContainerFdCache:
+    """LRU of container fds. An fd evicted or invalidated while a user still holds
+    it is closed once that user is done with it. Writable caches create missing
+    containers on open."""
+
+    def __init__(self, chunk_dir, capacity=FD_CACHE_SIZE, writable=False):
+        self.chunk_dir = chunk_dir
+        self.capacity = capacity
+        self.writable = writable
+        self.flags = (os.O_WRONLY | os.O_CREAT if writable else os.O_RDONLY) | getattr(os, "O_NOATIME", 0)
+        self._entries = OrderedDict()  # container_name: [fd, active users]
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def acquire(self, name):
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None:
+                entry = [self._open(name), 0]
+                self._entries[name] = entry
+                self._evict()
+            else:
+                self._entries.move_to_end(name)
+            entry[1] += 1
+        try:
+            yield entry[0]
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if entry[1] == 0 and self._entries.get(name) is not entry:
+                    os.close(entry[0])
+
+    def invalidate(self, name):
+        with self._lock:
+            self._retire(self._entries.pop(name, None))
+
+    def close(self):
+        with self._lock:
+            while self._entries:
+                self._retire(self._entries.popitem()[1])
+
+    def _open(self, name):
+        path = os.path.join(self.chunk_dir, name)
+        try:
+            fd = os.open(path, self.flags, 0o644)
+        except PermissionError:
+            # O_NOATIME is only allowed for the file owner
+            fd = os.open(path, self.flags & ~getattr(os, "O_NOATIME", 0), 0o644)
+        if not self.writable and hasattr(os, "posix_fadvise"):
+            # Reads follow chunk references, not file order; skip kernel readahead
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_RANDOM)
+        return fd
+
+    def _evict(self):
+        while len(self._entries) > self.capacity:
+            self._retire(self._entries.popitem(last=False)[1])
+
+    def _retire(self, entry):
+        if entry is not None and entry[1] == 0:
+            os.close(entry[0])
 
 class ChunkStorage:
     def __init__(self, chunk_dir):
         self.chunk_dir = chunk_dir
         os.makedirs(self.chunk_dir, exist_ok=True)
 
-        self.file_chunks_path = os.path.join(self.chunk_dir, "file_chunks.json")
+        self.file_db_path = os.path.join(self.chunk_dir, "file_chunks.db")
+        self.chunk_table_path = os.path.join(self.chunk_dir, "chunk_table.bin")
+        self.containers_path = os.path.join(self.chunk_dir, "containers.txt")
+        # Earlier index and file map formats, imported once on first start
         self.chunk_metadata_path = os.path.join(self.chunk_dir, "chunk_metadata.json")
+        self.file_chunks_path = os.path.join(self.chunk_dir, "file_chunks.json")
 
         # Metadata caches
         self.file_chunks = {}
-        self.chunk_metadata = {}
+        self.dirty_files = {}  # path: first chunk index changed since the last batch
+        self.chunk_metadata = None
+        self.file_db = None
+        self.container_sizes = {}  # container_name: size, filled from stat on first use
 
         # Locks
         self.chunk_metadata_lock = threading.RLock()
         self.file_chunks_lock = threading.RLock()
         self.container_locks = {}
+        # Held by a store from its dedup lookup until its chunk list is recorded, and by
+        # GC while it drops or moves chunks, so neither sees the other half done
+        self.store_gate = threading.RLock()
+        # Held while a compacted container is swapped in and its new offsets published;
+        # relocations counts the swaps, so a read can tell one overlapped it
+        self.relocation_lock = threading.Lock()
+        self.relocations = 0
+
+        # Cached fds for the read and write paths
+        self.read_fds = ContainerFdCache(self.chunk_dir)
+        self.write_fds = ContainerFdCache(self.chunk_dir, writable=True)
 
         # Background I/O queue
         self.io_queue = queue.Queue()
@@ -30,100 +125,242 @@ class ChunkStorage:
         self._load_file_chunks()
         self._load_chunk_metadata()
 
-    def store_file_chunks(self, path, chunks):
+    def store_file_chunks(self, path, chunks, first_changed=0):
+        # Chunks before first_changed must be the ones stored last time; only the rest is rewritten.
+        # None removes the file.
         with self.file_chunks_lock:
-            self.file_chunks[path] = chunks
+            if chunks is None:
+                self.file_chunks.pop(path, None)
+            else:
+                self.file_chunks[path] = chunks
+            self.dirty_files[path] = min(self.dirty_files.get(path, first_changed), first_changed)
             self._schedule_metadata_dump('file_chunks')
 
     def write_chunk_metadata(self, new_metadata: dict):
-        transformed_metadata = {}
-        for chunk_hash, (path, offset, size) in new_metadata.items():
-            container_name = path.strip("/").replace("/", "_") + ".container"
-            transformed_metadata[chunk_hash] = (container_name, offset, size)
+        # new_metadata: chunk_hash: (container_name, offset, size), inserted in one batch
+        with self.chunk_metadata_lock:
+            self.chunk_metadata.update(new_metadata)
+
+    def delete_chunk_metadata(self, chunk_hashes):
+        if not chunk_hashes:
+            return
+        # Deleting rebuilds the whole table, so callers batch their deletions
+        with self.chunk_metadata_lock:
+            self.chunk_metadata.delete(list(chunk_hashes))
 
+    def relocate_chunks(self, new_metadata: dict):
+        # Entries deleted since the caller read them stay deleted
         with self.chunk_metadata_lock:
-            self.chunk_metadata.update(transformed_metadata)
-            self._schedule_metadata_dump('chunk_metadata')
+            deleted = self.chunk_metadata.missing(list(new_metadata))
+            self.chunk_metadata.update({
+                chunk_hash: meta for chunk_hash, meta in new_metadata.items() if chunk_hash not in deleted
+            })
+
+    def replace_container(self, container_name, temp_path, new_metadata: dict):
+        # The file and its index entries change together as far as relocated_since() can tell
+        with self.relocation_lock:
+            os.replace(temp_path, os.path.join(self.chunk_dir, container_name))
+            self.invalidate_container(container_name)
+            self.relocate_chunks(new_metadata)
+            self.relocations += 1
+
+    def relocated_since(self, relocations):
+        # True if a container was replaced, or is being replaced, since relocations was read.
+        # Waits for a replacement in progress, so the caller can retry at once.
+        if self.relocation_lock.locked() or self.relocations != relocations:
+            with self.relocation_lock:
+                return True
+        return False
+
+    def container_lock(self, container_name):
+        return self._get_container_lock(container_name)
 
     def write_container(self, path, data, offset):
-        container_name = path.strip("/").replace("/", "_") + ".container"
-        container_path = os.path.join(self.chunk_dir, container_name)
+        container_name = container_name_for(path)
 
+        # One positioned write on a cached fd instead of open, seek, write and close
         lock = self._get_container_lock(container_name)
-        with lock:
-            mode = 'r+b' if os.path.exists(container_path) else 'wb'
-            with open(container_path, mode) as f:
-                f.seek(offset)
-                f.write(data)
+        with lock, self.write_fds.acquire(container_name) as fd, memoryview(data) as view:
+            while view:
+                written = os.pwrite(fd, view, offset)
+                view = view[written:]
+                offset += written
+            self.container_sizes[container_name] = max(self.get_container_size(container_name), offset)
+
+    def read_container(self, container_name, buffers, offset):
+        # Scatter-read one contiguous container range into the given buffers
+        with self.read_fds.acquire(container_name) as fd:
+            return os.preadv(fd, buffers, offset)
+
+    def invalidate_container(self, container_name):
+        # Call after a container file is replaced or removed
+        self.read_fds.invalidate(container_name)
+        self.write_fds.invalidate(container_name)
+        self.container_sizes.pop(container_name, None)
 
     def get_chunk_metadata(self, chunk_hash):
         with self.chunk_metadata_lock:
             return self.chunk_metadata.get(chunk_hash)
 
+    def get_chunk_metadata_many(self, chunk_hashes):
+        # One lock round-trip and one table probe for a whole read instead of one per chunk
+        chunk_hashes = list(chunk_hashes)
+        with self.chunk_metadata_lock:
+            found = self.chunk_metadata.get_many(chunk_hashes)
+        return {chunk_hash: meta for chunk_hash, meta in zip(chunk_hashes, found) if meta}
+
+    def get_container_chunks(self, container_name):
+        with self.chunk_metadata_lock:
+            return self.chunk_metadata.container_entries(container_name)
+
+    def get_chunks_by_container(self):
+        with self.chunk_metadata_lock:
+            return self.chunk_metadata.entries_by_container()
+
+    def missing_chunks(self, chunk_hashes):
+        with self.chunk_metadata_lock:
+            return self.chunk_metadata.missing(list(chunk_hashes))
+
     def chunk_exists(self, chunk_hash):
         with self.chunk_metadata_lock:
             return chunk_hash in self.chunk_metadata
 
     def get_container_size(self, container_path):
-        full_path = os.path.join(self.chunk_dir, container_path)
-        return os.path.getsize(full_path) if os.path.exists(full_path) else 0
+        size = self.container_sizes.get(container_path)
+        if size is None:
+            full_path = os.path.join(self.chunk_dir, container_path)
+            size = os.path.getsize(full_path) if os.path.exists(full_path) else 0
+            self.container_sizes[container_path] = size
+        return size
 
     def get_all_file_chunks(self):
         with self.file_chunks_lock:
             return dict(self.file_chunks)
         
     def get_all_chunk_hashes(self):
-        hashes = set()
         with self.chunk_metadata_lock:
-            for chunk_hash, _ in self.chunk_metadata.items():
-                hashes.add(chunk_hash)
-        return hashes
+            return set(self.chunk_metadata.keys())
 
     #Internal Operations
 
+    # A file's chunks are kept as parallel arrays, (hashes, sizes), as scan_range returns them.
+    # Hashes are raw digest bytes, stored as BLOBs. Stores written before the BLAKE3
+    # switch hold SHA-256 keys; they still resolve since lookups are by key only.
     def _load_file_chunks(self):
-        if os.path.exists(self.file_chunks_path):
+        # Only the background writer touches the connection once loading is done
+        self.file_db = sqlite3.connect(self.file_db_path, check_same_thread=False)
+        self.file_db.executescript("""
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=NORMAL;
+            PRAGMA temp_store=MEMORY;
+            PRAGMA mmap_size=268435456;
+            CREATE TABLE IF NOT EXISTS files (file_path TEXT PRIMARY KEY) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS file_map (
+                file_path TEXT NOT NULL,
+                chunk_index INTEGER NOT NULL,
+                chunk_hash BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                PRIMARY KEY (file_path, chunk_index)
+            ) WITHOUT ROWID;
+        """)
+
+        rows = {path: [] for path, in self.file_db.execute("SELECT file_path FROM files")}
+        for path, chunk_hash, size in self.file_db.execute(
+                "SELECT file_path, chunk_hash, size FROM file_map ORDER BY file_path, chunk_index"):
+            rows[path].append((chunk_hash, size))
+        self.file_chunks = {path: self._chunk_arrays(chunks) for path, chunks in rows.items()}
+
+        if os.path.exists(self.file_chunks_path) and not self.file_chunks:
             try:
                 with open(self.file_chunks_path, 'r') as f:
-                    self.file_chunks = json.load(f)
-            except (json.JSONDecodeError, IOError):
-                self.file_chunks = {}
+                    legacy = {
+                        path: self._chunk_arrays([(bytes.fromhex(chunk_hash), size) for chunk_hash, size in chunks])
+                        for path, chunks in json.load(f).items()
+                    }
+            except (json.JSONDecodeError, IOError, ValueError):
+                return
+            self._write_file_chunks({path: (0, chunks) for path, chunks in legacy.items()})
+            self.file_chunks = legacy
+            os.remove(self.file_chunks_path)
+
+    def _write_file_chunks(self, files):
+        # files: path: (first_changed, chunks). One transaction for the whole batch, and
+        # each file only has its rows from first_changed on replaced; None removes the file.
+        with self.file_db:
+            for path, (first_changed, chunks) in files.items():
+                self.file_db.execute(
+                    "DELETE FROM file_map WHERE file_path = ? AND chunk_index >= ?", (path, first_changed)
+                )
+                if chunks is None:
+                    self.file_db.execute("DELETE FROM files WHERE file_path = ?", (path,))
+                    continue
+                hashes, sizes = chunks
+                self.file_db.execute("INSERT OR IGNORE INTO files (file_path) VALUES (?)", (path,))
+                self.file_db.executemany(
+                    "INSERT INTO file_map (file_path, chunk_index, chunk_hash, size) VALUES (?, ?, ?, ?)",
+                    [(path, i, chunk_hash, size) for i, (chunk_hash, size) in enumerate(
+                        zip(digest_list(hashes[first_changed:]), sizes[first_changed:].tolist()), first_changed
+                    )],
+                )
+
+    def _chunk_arrays(self, chunks):
+        # [(chunk_hash, size), ...] as loaded from disk, to (hashes, sizes)
+        hashes = np.frombuffer(b"".join(chunk_hash for chunk_hash, _ in chunks), dtype=np.uint8)
+        sizes = np.fromiter((size for _, size in chunks), dtype=np.uint32, count=len(chunks))
+        return hashes.reshape(-1, DIGEST_SIZE), sizes
 
     def _load_chunk_metadata(self):
-        if os.path.exists(self.chunk_metadata_path):
+        self.chunk_metadata = MetaStore(self.chunk_table_path, self.containers_path)
+        if os.path.exists(self.chunk_metadata_path) and not len(self.chunk_metadata):
             try:
                 with open(self.chunk_metadata_path, 'r') as f:
-                    self.chunk_metadata = json.load(f)
-            except (json.JSONDecodeError, IOError):
-                self.chunk_metadata = {}
+                    legacy = {
+                        bytes.fromhex(chunk_hash): tuple(meta)
+                        for chunk_hash, meta in json.load(f).items()
+                    }
+            except (json.JSONDecodeError, IOError, ValueError):
+                return
+            self.chunk_metadata.rewrite(legacy)
+            os.remove(self.chunk_metadata_path)
 
     def _schedule_metadata_dump(self, target):
         self.io_queue.put(target)
 
-    def _atomic_write(self, path, data):
-        #if os.path.exists(path):
-        #    shutil.move(path, path + ".bak")
-        
-        tmp_path = path + ".tmp"
-        with open(tmp_path, 'w') as f:
-            json.dump(data, f)
-            f.flush()
-            os.fsync(f.fileno())
-        os.replace(tmp_path, path)
-
     def _background_writer(self):
+        failures = 0
         while True:
             try:
-                target = self.io_queue.get()
-                if target == 'file_chunks':
+                # Requests queued while the last dump ran are all served by the next one
+                targets = {self.io_queue.get()}
+                while True:
+                    try:
+                        targets.add(self.io_queue.get_nowait())
+                    except queue.Empty:
+                        break
+                if 'file_chunks' in targets:
+                    # Only paths changed since the last batch are written
                     with self.file_chunks_lock:
-                        self._atomic_write(self.file_chunks_path, self.file_chunks)
-                elif target == 'chunk_metadata':
-                    with self.chunk_metadata_lock:
-                        self._atomic_write(self.chunk_metadata_path, self.chunk_metadata)
+                        changed = {
+                            path: (first_changed, self.file_chunks.get(path))
+                            for path, first_changed in self.dirty_files.items()
+                        }
+                        self.dirty_files.clear()
+                    try:
+                        self._write_file_chunks(changed)
+                    except Exception:
+                        # Put the batch back, keeping the earliest change per path, and retry it
+                        with self.file_chunks_lock:
+                            for path, (first_changed, _) in changed.items():
+                                self.dirty_files[path] = min(self.dirty_files.get(path, first_changed), first_changed)
+                            self._schedule_metadata_dump('file_chunks')
+                        raise
+                failures = 0
             except Exception as e:
-                #Posibble log
-                print(f"[ChunkStorage] Error in background writer: {e}")
+                # Logged once per run of failures; a failing disk is retried with backoff, not spun on
+                if not failures:
+                    print(f"[ChunkStorage] Error in background writer: {e}")
+                time.sleep(min(RETRY_DELAY * 2 ** failures, RETRY_DELAY_MAX))
+                failures += 1
 
     def _get_container_lock(self, name):
         if name not in self.container_locks:
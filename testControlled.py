@@ -1,11 +1,11 @@
 import os
-import random
 import time
-import threading
+import multiprocessing
+import numpy as np
 
 MOUNT_PATH = './mountPoint'
 NUM_FILES = 10
-NUM_THREADS = 1
+NUM_PROCESSES = 1
 MIN_SIZE = 1024 * 1024 * 4 # 4 MB
 MAX_SIZE = 1024 * 1024 * 5 # 5 MB
 BLOCK_SIZE = 1024 * 4      # 4 KB
@@ -13,74 +13,75 @@ FRAGMENT_CHANCE = 0.05     # 0% chance to insert noise
 FRAGMENT_MIN = 1024
 FRAGMENT_MAX = 1024 * 5
 BLOCK_POOL_SIZE = 2500
+FRAGMENT_POOL_SIZE = 1024 * 1024 * 16 # 16 MB of noise that fragments are sliced from
 
-# Shared counter with lock
-total_bytes_written = 0
-counter_lock = threading.Lock()
-
-# Shared block pool
+# Block and fragment pools, generated once per worker process. Every worker uses the
+# same seed, so all files draw from the same blocks, as they would with one shared pool.
 BLOCK_POOL = []
+FRAGMENT_POOL = b""
 
-def initialize_block_pool():
-    global BLOCK_POOL
-    BLOCK_POOL = [os.urandom(BLOCK_SIZE) for _ in range(BLOCK_POOL_SIZE)]
-    print(f"Initialized block pool with {BLOCK_POOL_SIZE} blocks of size {BLOCK_SIZE} bytes")
+def initialize_block_pool(seed):
+    global BLOCK_POOL, FRAGMENT_POOL
+    rng = np.random.default_rng(seed)
+    pool = rng.bytes(BLOCK_POOL_SIZE * BLOCK_SIZE)
+    BLOCK_POOL = [pool[i * BLOCK_SIZE:(i + 1) * BLOCK_SIZE] for i in range(BLOCK_POOL_SIZE)]
+    FRAGMENT_POOL = rng.bytes(FRAGMENT_POOL_SIZE)
+    print(f"[Process {os.getpid()}] Initialized block pool with {BLOCK_POOL_SIZE} blocks of size {BLOCK_SIZE} bytes")
 
-def get_random_block():
-    return random.choice(BLOCK_POOL)
+def get_random_block(rng):
+    return BLOCK_POOL[rng.integers(BLOCK_POOL_SIZE)]
 
-def write_files(thread_id, start_index, num_files):
-    global total_bytes_written
+def write_files(worker_id, start_index, num_files):
+    rng = np.random.default_rng()
+    bytes_written = 0
 
     for i in range(start_index, start_index + num_files):
-        size = random.randint(MIN_SIZE, MAX_SIZE)
+        size = int(rng.integers(MIN_SIZE, MAX_SIZE, endpoint=True))
         filename = f"random_file_{i}.bin"
         filepath = os.path.join(MOUNT_PATH, filename)
 
-        print(f"[Thread {thread_id}] Writing {filename} of size {size} bytes...")
+        print(f"[Worker {worker_id}] Writing {filename} of size {size} bytes...")
         with open(filepath, 'wb') as f:
             written = 0
             while written < size:
                 to_write = min(BLOCK_SIZE, size - written)
-                block = get_random_block()[:to_write]
+                block = get_random_block(rng)[:to_write]
 
                 # Maybe insert fragment inside the block
-                if random.random() < FRAGMENT_CHANCE:
-                    frag_size = random.randint(FRAGMENT_MIN, FRAGMENT_MAX)
-                    frag = os.urandom(frag_size)
-                    insert_pos = random.randint(0, len(block))
+                if rng.random() < FRAGMENT_CHANCE:
+                    frag_size = int(rng.integers(FRAGMENT_MIN, FRAGMENT_MAX, endpoint=True))
+                    frag_start = int(rng.integers(0, FRAGMENT_POOL_SIZE - FRAGMENT_MAX))
+                    frag = FRAGMENT_POOL[frag_start:frag_start + frag_size]
+                    insert_pos = int(rng.integers(0, len(block), endpoint=True))
                     block = block[:insert_pos] + frag + block[insert_pos:]
                     to_write = len(block)  # Adjust written size
 
                 f.write(block)
                 written += to_write
+                bytes_written += to_write
 
-                with counter_lock:
-                    total_bytes_written += to_write
+    return bytes_written
 
 def main():
-    initialize_block_pool()
-    threads = []
-    files_per_thread = NUM_FILES // NUM_THREADS
-    remainder = NUM_FILES % NUM_THREADS
+    files_per_worker = NUM_FILES // NUM_PROCESSES
+    remainder = NUM_FILES % NUM_PROCESSES
+    tasks = []
     start_index = 0
-
-    start_time = time.time()
-    for i in range(NUM_THREADS):
-        count = files_per_thread + (1 if i < remainder else 0)
-        t = threading.Thread(target=write_files, args=(i, start_index, count))
-        threads.append(t)
-        t.start()
+    for i in range(NUM_PROCESSES):
+        count = files_per_worker + (1 if i < remainder else 0)
+        tasks.append((i, start_index, count))
         start_index += count
 
-    for t in threads:
-        t.join()
+    seed = int(np.random.SeedSequence().entropy)
+    with multiprocessing.Pool(NUM_PROCESSES, initializer=initialize_block_pool, initargs=(seed,)) as pool:
+        start_time = time.time()
+        total_bytes_written = sum(pool.starmap(write_files, tasks))
 
     end_time = time.time()
     duration = end_time - start_time
 
     total_mb = total_bytes_written / (1024 * 1024)
-    print(f"\nFinished writing {NUM_FILES} files with {NUM_THREADS} threads.")
+    print(f"\nFinished writing {NUM_FILES} files with {NUM_PROCESSES} processes.")
     print(f"Total data written (including noise): {total_mb:.2f} MB")
     print(f"Total elapsed time: {duration:.2f} seconds")
 